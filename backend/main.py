@@ -1,18 +1,25 @@
 # main.py
 import os
+import sys
 import time
 import json
 import asyncio
-from typing import Any, AsyncGenerator, Dict, List, Optional
-
-from fastapi import FastAPI, Request, HTTPException, Body, Header
-from fastapi.responses import StreamingResponse, JSONResponse
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Type, TypeVar
+
+from fastapi import FastAPI, Request, HTTPException, Depends, Header
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 import httpx
-from pydantic import BaseModel
+import msgspec
 from functools import wraps
 
 # LangChain Google GenAI integration (for streaming)
 from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
 # Google GenAI SDK (for listing models)
 from google import genai
 
@@ -20,33 +27,121 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="NextGenAI Backend (FastAPI + Google GenAI + LiteLLM adapter)")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled HTTP client for the whole process so outbound calls reuse keep-alive connections
+    app.state.http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        timeout=10.0,
+        http2=True,
+    )
+    try:
+        yield
+    finally:
+        await app.state.http_client.aclose()
+        for client in _GENAI_CLIENTS.values():
+            await close_genai_client(client)
+        _GENAI_CLIENTS.clear()
+
+
+app = FastAPI(
+    title="NextGenAI Backend (FastAPI + Google GenAI + LiteLLM adapter)",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+
+class JSONGZipMiddleware:
+    """
+    Gzip only the JSON endpoints listed in `paths`. The token streams from /chat and /complete
+    bypass compression so every chunk reaches the client as soon as it is produced.
+    """
+
+    def __init__(self, app: ASGIApp, paths: Set[str], minimum_size: int = 512):
+        self.app = app
+        self.paths = paths
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and scope["path"] in self.paths:
+            await self.gzip(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(JSONGZipMiddleware, paths={"/fetch_models", "/models"}, minimum_size=512)
 
 # ---- Configuration ----
 DEFAULT_GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 DEFAULT_PORT = int(os.environ.get("PORT", "8000"))
+# Model/LLM caches, single-flight and invalidation are per-process state, so the default is one
+# worker; WORKERS>1 is opt-in and each worker then keeps (and invalidates) its own caches.
+DEFAULT_WORKERS = int(os.environ.get("WORKERS", "1"))
 
 # supported provider keys
 PROVIDERS = {"google", "litellm"}
 
-# Simple in-memory cache for model lists with TTL
+# In-memory cache for model lists. Entries past the TTL are served stale while a
+# single background task per provider refreshes them.
 _MODEL_CACHE: Dict[str, Dict[str, Any]] = {}
 MODEL_CACHE_TTL = 300  # seconds
-
-
-# ---------- Pydantic models ----------
-class MessageHistory(BaseModel):
+# bumped per provider by invalidation; fetches started under an older generation are not cached
+_MODEL_CACHE_GEN: Dict[str, int] = {}
+# in-flight cold-cache fetches keyed by provider + credential hash; concurrent callers share one
+_INFLIGHT: Dict[str, asyncio.Future] = {}
+# strong references so background refresh tasks are not garbage collected mid-flight
+_REFRESH_TASKS: Set[asyncio.Task] = set()
+
+# Reused LLM clients keyed by (model, temperature, api_key hash), bounded LRU
+_LLM_CACHE: "OrderedDict[tuple, ChatGoogleGenerativeAI]" = OrderedDict()
+LLM_CACHE_MAX_SIZE = 64
+
+# Reused google.genai clients keyed by api_key hash, bounded LRU
+_GENAI_CLIENTS: "OrderedDict[str, genai.Client]" = OrderedDict()
+GENAI_CLIENTS_MAX_SIZE = 64
+
+# Streaming: coalesce small model chunks into one response write
+STREAM_FLUSH_BYTES = 1024
+STREAM_FLUSH_INTERVAL = 0.03  # seconds
+STREAM_QUEUE_SIZE = 64  # chunks read ahead of the client before upstream is paused
+_STREAM_END = object()
+
+# Chat history window sent upstream; oldest turns are dropped first
+MAX_HISTORY_TURNS = 32
+MAX_HISTORY_BYTES = 32_000
+
+# Chat history role -> LangChain message class (same aliases LangChain accepts for role dicts)
+_ROLE_MESSAGES = {
+    "user": HumanMessage,
+    "human": HumanMessage,
+    "assistant": AIMessage,
+    "ai": AIMessage,
+    "system": SystemMessage,
+    "developer": SystemMessage,
+}
+
+# Inline completion prompts
+PROMPT_LANG = (
+    "You are an expert {language} programmer. Complete the code snippet below in a concise, "
+    "correct, and idiomatic way.\n\nContext:\n{context}\n\nPrefix:\n{prefix}\n\nCompletion:"
+)
+PROMPT_GENERIC = "Complete this code:\n\n{context}\n\n{prefix}\n\nCompletion:"
+
+
+# ---------- Request models ----------
+class MessageHistory(msgspec.Struct):
     role: str
     content: str
 
 
-class FetchModelsPayload(BaseModel):
+class FetchModelsPayload(msgspec.Struct):
     provider: str
     api_key: Optional[str] = None
     base_url: Optional[str] = None
 
 
-class ChatPayload(BaseModel):
+class ChatPayload(msgspec.Struct, kw_only=True):
     session_id: Optional[str] = None
     message: str
     model: Optional[str] = None
@@ -56,7 +151,7 @@ class ChatPayload(BaseModel):
     history: Optional[List[MessageHistory]] = []
 
 
-class CompletePayload(BaseModel):
+class CompletePayload(msgspec.Struct, kw_only=True):
     prefix: str
     context: Optional[str] = ""
     language: Optional[str] = None
@@ -67,36 +162,302 @@ class CompletePayload(BaseModel):
     api_key: Optional[str] = None
 
 
+Payload = TypeVar("Payload", bound=msgspec.Struct)
+
+
+def json_body(model: Type[Payload]) -> Callable[[Request], Awaitable[Payload]]:
+    """
+    Dependency that decodes and validates the raw JSON request body straight into `model`.
+    """
+    async def decode(request: Request) -> Payload:
+        try:
+            # strict=False keeps Pydantic's lax coercions, e.g. "0.5" -> 0.5 and 1.0 -> 1
+            return msgspec.json.decode(await request.body(), type=model, strict=False)
+        except msgspec.ValidationError as e:
+            raise HTTPException(status_code=422, detail=[{"type": "value_error", "loc": ["body"], "msg": str(e)}])
+        except msgspec.DecodeError as e:
+            raise HTTPException(status_code=422, detail=[{"type": "json_invalid", "loc": ["body"], "msg": str(e)}])
+
+    return decode
+
+
 # ---------- Utility functions ----------
-def cache_models(provider: str, models: List[str]):
-    _MODEL_CACHE[provider] = {"models": models, "ts": time.time()}
+def model_cache_generation(provider: str) -> int:
+    return _MODEL_CACHE_GEN.get(provider, 0)
+
+
+def cache_models(provider: str, models: List[str], generation: Optional[int] = None) -> bool:
+    """
+    Store models for provider. If `generation` is given and the provider was invalidated since it
+    was read, the result is dropped so data fetched before an invalidation is not written back.
+    """
+    if generation is not None and generation != model_cache_generation(provider):
+        return False
+    expires_at = time.monotonic() + MODEL_CACHE_TTL
+    entry = _MODEL_CACHE.get(provider)
+    if entry is None:
+        _MODEL_CACHE[provider] = {"models": models, "expires_at": expires_at, "lock": asyncio.Lock(), "refreshing": False}
+    else:
+        entry["models"] = models
+        entry["expires_at"] = expires_at
+    return True
 
 
-def get_cached_models(provider: str) -> Optional[List[str]]:
+async def _refresh_models(provider: str, fetch: Callable[[], Awaitable[List[str]]], generation: int):
+    entry = _MODEL_CACHE.get(provider)
+    if entry is None:
+        return
+    async with entry["lock"]:
+        try:
+            cache_models(provider, await fetch(), generation)
+        except Exception as e:
+            # keep serving the stale list; the next expired read schedules another attempt
+            print(f"Background model refresh for {provider} failed: {e}")
+        finally:
+            entry["refreshing"] = False
+
+
+def get_cached_models(
+    provider: str,
+    refresh: Optional[Callable[[], Awaitable[List[str]]]] = None,
+) -> Optional[List[str]]:
+    """
+    Return cached models for provider, or None if nothing usable is cached.
+    Expired entries are only returned when `refresh` is given, in which case one background
+    refresh is scheduled; without it (no credentials to refresh with) they count as a miss.
+    """
     entry = _MODEL_CACHE.get(provider)
     if not entry:
         return None
-    if time.time() - entry["ts"] > MODEL_CACHE_TTL:
-        _MODEL_CACHE.pop(provider, None)
-        return None
+    if entry["expires_at"] < time.monotonic():
+        if refresh is None:
+            return None
+        if not entry["refreshing"]:
+            entry["refreshing"] = True
+            task = asyncio.create_task(_refresh_models(provider, refresh, model_cache_generation(provider)))
+            _REFRESH_TASKS.add(task)
+            task.add_done_callback(_REFRESH_TASKS.discard)
     return entry["models"]
 
 
+class _FlightAbandoned(Exception):
+    """Set on a shared fetch whose leader was cancelled; waiters retry instead of failing."""
+
+
+async def single_flight(key: str, fetch: Callable[[], Awaitable[List[str]]]) -> List[str]:
+    """
+    Run fetch() once per key at a time; callers arriving while it is in flight await the same result.
+    If the caller running the fetch is cancelled, a waiting caller takes over and fetches again.
+    """
+    while True:
+        fut = _INFLIGHT.get(key)
+        if fut is None:
+            break
+        try:
+            # shield so one waiter being cancelled does not cancel the shared fetch
+            return await asyncio.shield(fut)
+        except _FlightAbandoned:
+            continue
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = fut
+    try:
+        result = await fetch()
+    except asyncio.CancelledError:
+        fut.set_exception(_FlightAbandoned())
+        fut.exception()  # mark retrieved when nobody was waiting
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved so an unwaited failure is not logged again
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        if _INFLIGHT.get(key) is fut:
+            del _INFLIGHT[key]
+
+
+def invalidate_cached_models(provider: Optional[str] = None) -> List[str]:
+    """
+    Drop cached models for provider (or all providers). Returns the providers that were evicted.
+    """
+    # bump generations first so in-flight fetches for these providers cannot repopulate the cache
+    for p in (PROVIDERS if provider is None else [provider]):
+        _MODEL_CACHE_GEN[p] = model_cache_generation(p) + 1
+    if provider is None:
+        evicted = list(_MODEL_CACHE)
+        _MODEL_CACHE.clear()
+        return evicted
+    return [provider] if _MODEL_CACHE.pop(provider, None) is not None else []
+
+
 def prefer_api_key(auth_header: Optional[str], body_key: Optional[str]) -> Optional[str]:
     """
     Prefer Authorization header Bearer token, then body api_key, then env default.
     """
     if auth_header:
         # expecting "Bearer <token>"
-        parts = auth_header.split()
-        if len(parts) == 2 and parts[0].lower() == "bearer":
-            return parts[1]
+        if auth_header[:7].lower() == "bearer ":
+            return auth_header[7:].strip()
         return auth_header  # fallback if header just contains raw key
     if body_key:
         return body_key
     return None
 
 
+def truncate_history(history: List[MessageHistory]) -> List[MessageHistory]:
+    """
+    Keep the newest turns of history that fit within MAX_HISTORY_TURNS and MAX_HISTORY_BYTES.
+    """
+    if len(history) > MAX_HISTORY_TURNS:
+        history = history[-MAX_HISTORY_TURNS:]
+    total = 0
+    for i in range(len(history) - 1, -1, -1):
+        total += len(history[i].content.encode())
+        if total > MAX_HISTORY_BYTES:
+            return history[i + 1:]
+    return history
+
+
+def get_llm(model: str, temperature: float, api_key: Optional[str]) -> ChatGoogleGenerativeAI:
+    """
+    Return a cached ChatGoogleGenerativeAI for (model, temperature, api_key), creating it on a miss.
+    The api key is hashed so raw credentials are not kept as dict keys.
+    """
+    key = (model, temperature, hashlib.sha256((api_key or "").encode()).hexdigest())
+    llm = _LLM_CACHE.get(key)
+    if llm is not None:
+        _LLM_CACHE.move_to_end(key)
+        return llm
+    llm = ChatGoogleGenerativeAI(model=model, temperature=temperature, api_key=api_key)
+    _LLM_CACHE[key] = llm
+    if len(_LLM_CACHE) > LLM_CACHE_MAX_SIZE:
+        # ChatGoogleGenerativeAI has no public close(); an evicted instance's transports are
+        # released when it is garbage collected (an in-flight stream keeps it alive until done)
+        _LLM_CACHE.popitem(last=False)
+    return llm
+
+
+def build_completion_prompt(language: Optional[str], context_text: str, prefix: str) -> str:
+    """
+    Render the inline completion prompt from the module-level templates.
+    """
+    values = {"language": language, "context": context_text, "prefix": prefix}
+    return (PROMPT_LANG if language else PROMPT_GENERIC).format_map(values)
+
+
+async def get_genai_client(api_key: str) -> genai.Client:
+    """
+    Return a cached google.genai client for api_key. A miss builds the client in a worker thread,
+    since construction is synchronous SDK setup (auth, transport).
+    """
+    key = hashlib.sha256(api_key.encode()).hexdigest()
+    client = _GENAI_CLIENTS.get(key)
+    if client is not None:
+        _GENAI_CLIENTS.move_to_end(key)
+        return client
+    client = await asyncio.to_thread(genai.Client, api_key=api_key)
+    _GENAI_CLIENTS[key] = client
+    if len(_GENAI_CLIENTS) > GENAI_CLIENTS_MAX_SIZE:
+        _, evicted = _GENAI_CLIENTS.popitem(last=False)
+        await close_genai_client(evicted)
+    return client
+
+
+async def close_genai_client(client: genai.Client):
+    """
+    Release the transports of an evicted client. The close methods only exist in newer SDK releases.
+    """
+    try:
+        aclose = getattr(client.aio, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        close = getattr(client, "close", None)
+        if close is not None:
+            close()
+    except Exception as e:
+        print(f"Closing evicted genai client failed: {e}")
+
+
+async def coalesce_stream(chunks: AsyncIterator[Any]) -> AsyncGenerator[bytes, None]:
+    """
+    Re-yield LLM stream chunks as encoded batches, flushing once STREAM_FLUSH_BYTES are buffered
+    or STREAM_FLUSH_INTERVAL has passed since the last write, even if the model pauses in between.
+    The first chunk is sent immediately.
+    """
+    loop = asyncio.get_running_loop()
+    # a single producer task drives the upstream generator, so its context stays in one task
+    queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    async def produce():
+        try:
+            async for chunk in chunks:
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_STREAM_END)
+
+    producer = asyncio.create_task(produce())
+    buf = bytearray()
+    last_flush = float("-inf")
+    try:
+        while True:
+            if buf:
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(last_flush + STREAM_FLUSH_INTERVAL - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    # model paused with text still buffered; send it now
+                    yield bytes(buf)
+                    buf.clear()
+                    last_flush = loop.time()
+                    continue
+            else:
+                item = await queue.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                # hand over what was already generated before the error propagates
+                if buf:
+                    yield bytes(buf)
+                raise item
+            buf.extend(item.content.encode())
+            now = loop.time()
+            if len(buf) >= STREAM_FLUSH_BYTES or now - last_flush > STREAM_FLUSH_INTERVAL:
+                yield bytes(buf)
+                buf.clear()
+                last_flush = now
+        if buf:
+            yield bytes(buf)
+    finally:
+        producer.cancel()
+
+
+async def start_stream(chunks: AsyncGenerator[Any, None]) -> AsyncGenerator[bytes, None]:
+    """
+    Pull the first chunk before the response starts, so upstream failures (bad key, unknown model)
+    surface as a 502 instead of a 200 with error text. Returns the coalesced byte stream.
+    """
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except Exception as e:
+        # close the partly started upstream generator now rather than leaving it to GC
+        await chunks.aclose()
+        raise HTTPException(status_code=502, detail=f"LLM request failed: {e}")
+
+    async def chained():
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+
+    return coalesce_stream(chained())
+
+
 # ---------- Provider adapters ----------
 async def google_list_models(api_key: Optional[str]) -> List[str]:
     api_key = api_key or DEFAULT_GOOGLE_API_KEY
@@ -104,27 +465,24 @@ async def google_list_models(api_key: Optional[str]) -> List[str]:
         raise HTTPException(status_code=400, detail="Google API key not provided")
 
     try:
-        client = genai.Client(api_key=api_key)
-        models = []
-        # SDK returns iterable/pager
-        for m in client.models.list():
-            # m may contain `name` (fully-qualified) or another attribute depending on SDK
-            name = getattr(m, "name", None) or getattr(m, "model", None) or str(m)
-            models.append(name)
-        return models
+        client = await get_genai_client(api_key)
+        # async pager: pages are fetched without blocking the event loop. Each page token comes
+        # from the previous response, so pages cannot be requested concurrently.
+        pager = await client.aio.models.list()
+        # m may contain `name` (fully-qualified) or another attribute depending on SDK
+        return [getattr(m, "name", None) or getattr(m, "model", None) or str(m) async for m in pager]
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Google GenAI list models failed: {e}")
 
 
-async def litellm_list_models(base_url: str) -> List[str]:
+async def litellm_list_models(client: httpx.AsyncClient, base_url: str) -> List[str]:
     if not base_url:
         raise HTTPException(status_code=400, detail="base_url required for litellm provider")
-    async with httpx.AsyncClient(timeout=10) as client:
-        resp = await client.get(f"{base_url.rstrip('/')}/models")
-        if resp.status_code != 200:
-            raise HTTPException(status_code=502, detail=f"litellm responded {resp.status_code}: {resp.text}")
-        data = resp.json()
-        return data.get("models", [])
+    resp = await client.get(f"{base_url.rstrip('/')}/models")
+    if resp.status_code != 200:
+        raise HTTPException(status_code=502, detail=f"litellm responded {resp.status_code}: {resp.text}")
+    data = resp.json()
+    return data.get("models", [])
 
 
 # ---------- Endpoints ----------
@@ -135,7 +493,11 @@ async def health():
 
 
 @app.post("/fetch_models")
-async def fetch_models(payload: FetchModelsPayload, authorization: Optional[str] = Header(None)):
+async def fetch_models(
+    request: Request,
+    payload: FetchModelsPayload = Depends(json_body(FetchModelsPayload)),
+    authorization: Optional[str] = Header(None),
+):
     """
     Fetch models for provider. Body includes provider, and either api_key or base_url (for litellm).
     The endpoint returns {"models": [...]}
@@ -147,21 +509,28 @@ async def fetch_models(payload: FetchModelsPayload, authorization: Optional[str]
     if provider not in PROVIDERS:
         raise HTTPException(status_code=400, detail=f"Unsupported provider: {provider}")
 
-    # return cached if exists
-    cached = get_cached_models(provider)
-    if cached:
-        return JSONResponse({"models": cached, "cached": True})
-
-    if provider == "google":
-        models = await google_list_models(api_key=api_key)
-    elif provider == "litellm":
-        models = await litellm_list_models(base_url=base_url)
-    else:
-        models = []
+    async def fetch() -> List[str]:
+        if provider == "google":
+            return await google_list_models(api_key=api_key)
+        if provider == "litellm":
+            return await litellm_list_models(request.app.state.http_client, base_url=base_url)
+        return []
+
+    # return cached if exists (stale entries are refreshed in the background)
+    cached = get_cached_models(provider, refresh=fetch)
+    if cached is not None:
+        return ORJSONResponse({"models": cached, "cached": True})
+
+    async def fetch_and_cache() -> List[str]:
+        generation = model_cache_generation(provider)
+        models = await fetch()
+        cache_models(provider, models, generation)
+        return models
 
-    # cache result
-    cache_models(provider, models)
-    return JSONResponse({"models": models, "cached": False})
+    # cold cache: concurrent requests for the same provider + credentials share one upstream call
+    flight_key = f"{provider}:{hashlib.sha256(f'{api_key}|{base_url}'.encode()).hexdigest()}"
+    models = await single_flight(flight_key, fetch_and_cache)
+    return ORJSONResponse({"models": models, "cached": False})
 
 
 @app.get("/models")
@@ -176,17 +545,30 @@ async def models_list(provider: Optional[str] = None):
             raise HTTPException(status_code=400, detail=f"Unsupported provider: {provider}")
         cached = get_cached_models(provider)
         if cached is not None:
-            return JSONResponse({"provider": provider, "models": cached, "cached": True})
+            return ORJSONResponse({"provider": provider, "models": cached, "cached": True})
         # fallback to ask client to call /fetch_models with credentials
         raise HTTPException(status_code=404, detail="No cached models for provider; call /fetch_models with credentials")
-    # return all cached
-    data = {k: v["models"] for k, v in _MODEL_CACHE.items()}
-    return JSONResponse({"cached_models": data})
+    # return all cached (expired lists are left out, as for a single provider)
+    data = {k: models for k in list(_MODEL_CACHE) if (models := get_cached_models(k)) is not None}
+    return ORJSONResponse({"cached_models": data})
+
+
+@app.post("/invalidate_models")
+async def invalidate_models(provider: Optional[str] = None):
+    """
+    Evict cached model lists, e.g. after rotating credentials.
+    Query param: provider=google|litellm (optional, defaults to all providers)
+    """
+    if provider:
+        provider = provider.lower()
+        if provider not in PROVIDERS:
+            raise HTTPException(status_code=400, detail=f"Unsupported provider: {provider}")
+    return ORJSONResponse({"invalidated": invalidate_cached_models(provider)})
 
 
 @app.post("/chat")
 async def chat_stream(
-    payload: ChatPayload = Body(...),
+    payload: ChatPayload = Depends(json_body(ChatPayload)),
     authorization: Optional[str] = Header(None),
 ):
     """
@@ -198,6 +580,8 @@ async def chat_stream(
     Returns StreamingResponse (text/plain, chunked).
     """
     api_key = prefer_api_key(authorization, payload.api_key) or DEFAULT_GOOGLE_API_KEY
+    if not api_key:
+        raise HTTPException(status_code=401, detail="API key required")
     message = payload.message
     if not message:
         raise HTTPException(status_code=400, detail="message is required")
@@ -205,32 +589,27 @@ async def chat_stream(
     model = payload.model or "gemini-2.5-flash"
     temperature = float(payload.temperature or 0.0)
     max_tokens = payload.max_tokens
-    history = payload.history or []
-
-    # Build messages list with history + current message
-    messages = []
-    
-    # Add history to context
-    if history:
-        for msg in history:
-            messages.append({
-                "role": msg.get("role") if isinstance(msg, dict) else msg.role,
-                "content": msg.get("content") if isinstance(msg, dict) else msg.content
-            })
-    
-    # Add current message
-    messages.append({
-        "role": "user",
-        "content": message
-    })
+    history = truncate_history(payload.history or [])
 
-    llm = ChatGoogleGenerativeAI(model=model, temperature=temperature, api_key=api_key)
+    # Build messages list with history + current message (history is already validated by msgspec)
+    messages: List[BaseMessage] = []
+    for m in history:
+        message_cls = _ROLE_MESSAGES.get(m.role)
+        if message_cls is None:
+            raise HTTPException(status_code=400, detail=f"Unsupported history role: {m.role}")
+        messages.append(message_cls(content=m.content))
+    messages.append(HumanMessage(content=message))
+
+    llm = get_llm(model, temperature, api_key)
+
+    stream = await start_stream(llm.astream(input=messages))
 
     async def generator():
         try:
-            async for chunk in llm.astream(input=messages):
-                yield chunk.content
+            async for data in stream:
+                yield data
         except Exception as e:
+            # headers are already sent at this point, so report mid-stream failures in the body
             print(f"Error in chat_stream: {e}",type(e))
             yield str(e)
 
@@ -238,12 +617,17 @@ async def chat_stream(
 
 
 @app.post("/complete")
-async def complete_stream(payload: CompletePayload = Body(...), authorization: Optional[str] = Header(None)):
+async def complete_stream(
+    payload: CompletePayload = Depends(json_body(CompletePayload)),
+    authorization: Optional[str] = Header(None),
+):
     """
     Short completion endpoint optimized for inline suggestions.
     Builds a small prompt and streams tokens back.
     """
     api_key = prefer_api_key(authorization, payload.api_key) or DEFAULT_GOOGLE_API_KEY
+    if not api_key:
+        raise HTTPException(status_code=401, detail="API key required")
     prefix = payload.prefix
     if prefix is None:
         raise HTTPException(status_code=400, detail="prefix is required")
@@ -254,20 +638,24 @@ async def complete_stream(payload: CompletePayload = Body(...), authorization: O
     language = payload.language
     context_text = payload.context or ""
 
-    llm = ChatGoogleGenerativeAI(model=model, temperature=temperature, api_key=api_key)
+    llm = get_llm(model, temperature, api_key)
 
-    if language:
-        prompt = (
-            f"You are an expert {language} programmer. Complete the code snippet below in a concise, "
-            f"correct, and idiomatic way.\n\nContext:\n{context_text}\n\nPrefix:\n{prefix}\n\nCompletion:"
-        )
-    else:
-        prompt = f"Complete this code:\n\n{context_text}\n\n{prefix}\n\nCompletion:"
+    messages = [build_completion_prompt(language, context_text, prefix)]
 
-    messages = [prompt]
+    stream = await start_stream(llm.astream(input=messages))
 
-    async def generator():
-        async for chunk in llm.astream(input=messages):
-            yield chunk.content
+    return StreamingResponse(stream, media_type="text/plain; charset=utf-8")
+
+
+if __name__ == "__main__":
+    import uvicorn
 
-    return StreamingResponse(generator(), media_type="text/plain; charset=utf-8")
\ No newline at end of file
+    # uvloop is not available on Windows; uvicorn installs it in every worker process otherwise
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=DEFAULT_PORT,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=DEFAULT_WORKERS,
+    )
@@ -34,6 +34,10 @@ export class BackendClient {
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(payload)
     });
+    if (!res.ok) {
+      const txt = await res.text();
+      throw new Error(`chat failed: ${res.status} ${txt}`);
+    }
     if (!res.body) throw new Error('No stream in response');
 
     const reader = res.body.getReader();
@@ -61,6 +65,10 @@ export class BackendClient {
       body: JSON.stringify(payload),
       signal: sig
     });
+    if (!res.ok) {
+      const txt = await res.text();
+      throw new Error(`complete failed: ${res.status} ${txt}`);
+    }
     if (!res.body) throw new Error('No stream body');
     const reader = res.body.getReader();
     const decoder = new TextDecoder();